@@ -5,10 +5,10 @@
 # - Twilio optionnel (no-op en dev), signature activable
 # - Charge .env automatiquement (python-dotenv)
 
-import sys, os, time, uuid
-from typing import List, Dict
+import sys, os, time, uuid, math, json, threading
+from typing import List, Dict, Callable, Optional
 from flask import Flask, request, jsonify, Response, g
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 import unicodedata
 
@@ -181,11 +181,23 @@ coreapp.bootstrap_memory()
 def health():
     return jsonify({"status": "ok"}), 200
 
+def _internal_authorized(req) -> bool:
+    token = req.headers.get("X-Token") or ""
+    expect = os.environ.get("INTERNAL_TOKEN") or ""
+    return bool(expect) and token == expect
+
+def _internal_reply(user_id: str, text: str, no_llm: bool,
+                    gate: Optional[Callable[[str], str]] = None) -> str:
+    # gate(reply) est appelé avant le log OUT: renvoyer "" pour ne rien enregistrer
+    def _generate(t, h):
+        # NO-LLM: on log IN/OUT quand même pour rester isofonctionnel
+        reply = f"(NO-LLM) {t}" if no_llm else _generate_with_history(t, h)
+        return gate(reply) if gate else reply
+    return _clean_outgoing(coreapp.process_incoming(user_id, text, None, _generate))
+
 @app.route("/internal/send", methods=["POST"])
 def internal_send():
-    token = request.headers.get("X-Token") or ""
-    expect = os.environ.get("INTERNAL_TOKEN") or ""
-    if not expect or token != expect:
+    if not _internal_authorized(request):
         return jsonify({"error":"forbidden"}), 403
 
     data = request.get_json(silent=True) or {}
@@ -196,19 +208,262 @@ def internal_send():
     no_llm = (request.args.get("nollm","0") == "1")
 
     t0 = time.time()
-    if no_llm:
-        reply = f"(NO-LLM) {text}"
-        # on log IN/OUT quand même pour rester isofonctionnel
-        coreapp.process_incoming(user_id, text, None, lambda t,h: reply)
-    else:
-        reply = coreapp.process_incoming(user_id, text, None, _generate_with_history)
+    reply = _internal_reply(user_id, text, no_llm)
     dt = round((time.time()-t0)*1000)
-    reply = _clean_outgoing(reply)
 
 
     return jsonify({"ok": True, "ms": dt, "reply": reply, "no_llm": no_llm}), 200
 
 
+# ---- Envoi groupé (fan-out) ----
+# POST /internal/send/batch — corps JSON (liste ou {"jobs": [...]}) ou NDJSON
+# (une ligne {"user_id","text"} par job). Résultats streamés en NDJSON au fil
+# de l'eau (ordre de fin, pas d'entrée), puis une ligne {"done": true, ...}.
+# Query: ?nollm=1, ?deliver=1 (envoi WhatsApp), ?concurrency=N, ?timeout=S
+BATCH_MAX_JOBS    = int(os.environ.get("BATCH_MAX_JOBS", "1000"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_JOB_TIMEOUT = float(os.environ.get("BATCH_JOB_TIMEOUT", "20"))   # secondes par job
+
+def _parse_batch_jobs(req) -> List[Dict]:
+    raw = req.get_data(as_text=True) or ""
+    data = None
+    try:
+        data = json.loads(raw) if raw.strip() else []
+    except ValueError:
+        data = None
+    if data is None:
+        # NDJSON: un objet par ligne (lignes vides ignorées)
+        data = [json.loads(line) for line in raw.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        if "jobs" in data:
+            data = data["jobs"]
+        elif "user_id" in data:
+            data = [data]   # job unique (objet JSON ou NDJSON d'une ligne)
+        else:
+            raise ValueError("expected a list, {\"jobs\": [...]} or {\"user_id\", \"text\"}")
+    if not isinstance(data, list):
+        raise ValueError("jobs must be a list")
+    return data
+
+def _job_user_id(job) -> Optional[str]:
+    uid = str(job.get("user_id") or "").strip() if isinstance(job, dict) else ""
+    return uid.replace("whatsapp:", "") or None
+
+def _batch_job(idx: int, job, no_llm: bool, deliver: bool, state: Dict) -> Dict:
+    state["started"] = time.time()
+    user_id = _job_user_id(job)
+    res = {"i": idx, "user_id": user_id}
+    if not user_id:
+        res.update(ok=False, error="user_id manquant", ms=0)
+        return res
+    text = str(job.get("text") or "").strip() or "ping"
+
+    def _gate(reply: str) -> str:
+        # point de non-retour: soit le flux a déjà déclaré le timeout (rien
+        # n'est enregistré ni envoyé), soit le job est engagé (OUT + envoi)
+        with state["lock"]:
+            if state.get("expired"):
+                return ""
+            state["committed"] = True
+        return reply
+
+    try:
+        reply = _internal_reply(user_id, text, no_llm, gate=_gate)
+        res.update(ok=True, reply=reply)
+        if deliver and reply and state.get("committed"):
+            res["tw_sid"] = _send_whatsapp(f"whatsapp:{user_id}", reply)
+    except Exception as e:
+        print(f"[BATCH][err] i={idx} user={user_id} {e}", flush=True)
+        res.update(ok=False, error=str(e))
+    res["ms"] = round((time.time() - state["started"]) * 1000)
+    return res
+
+@app.route("/internal/send/batch", methods=["POST"])
+def internal_send_batch():
+    if not _internal_authorized(request):
+        return jsonify({"error":"forbidden"}), 403
+
+    try:
+        jobs = _parse_batch_jobs(request)
+    except ValueError as e:
+        return jsonify({"error": f"bad payload: {e}"}), 400
+    if len(jobs) > BATCH_MAX_JOBS:
+        return jsonify({"error": f"too many jobs (max {BATCH_MAX_JOBS})"}), 413
+
+    no_llm = (request.args.get("nollm","0") == "1")
+    deliver = (request.args.get("deliver","0") == "1")
+    try:
+        concurrency = int(request.args.get("concurrency", BATCH_CONCURRENCY))
+        job_timeout = float(request.args.get("timeout", BATCH_JOB_TIMEOUT))
+    except ValueError:
+        return jsonify({"error": "bad concurrency/timeout"}), 400
+    if not math.isfinite(job_timeout) or job_timeout <= 0:
+        return jsonify({"error": "timeout must be a positive number of seconds"}), 400
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+    req_id = getattr(g, "req_id", "-")
+
+    def _stream():
+        t0 = time.time()
+        # Au plus `concurrency` threads de génération, stragglers compris: un job
+        # déclaré en timeout garde sa place tant que son thread n'a pas rendu la main.
+        pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+        queue = iter(enumerate(jobs))
+        exhausted = False
+        states = {}
+        running = set()   # futures dont le thread tourne encore (timeouts inclus)
+        pending = {}      # futures dont le résultat n'a pas encore été streamé
+
+        def _fill():
+            nonlocal exhausted
+            while not exhausted and len(running) < concurrency:
+                nxt = next(queue, None)
+                if nxt is None:
+                    exhausted = True
+                    return
+                i, job = nxt
+                st = {"lock": threading.Lock()}
+                fut = pool.submit(_batch_job, i, job, no_llm, deliver, st)
+                states[fut] = (i, job, st)
+                running.add(fut)
+                pending[fut] = i
+
+        ok = failed = expired = 0
+        try:
+            _fill()
+            while pending or not exhausted:
+                done, _ = wait(running, timeout=0.2, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    running.discard(fut)
+                    if pending.pop(fut, None) is None:
+                        continue   # straggler déjà signalé en timeout
+                    res = fut.result()
+                    if res.get("ok"):
+                        ok += 1
+                    else:
+                        failed += 1
+                    yield json.dumps(res, ensure_ascii=False) + "\n"
+                # deadline par job: comptée à partir du démarrage effectif du job
+                now = time.time()
+                for fut in list(pending):
+                    i, job, st = states[fut]
+                    if not st.get("started") or now - st["started"] <= job_timeout:
+                        continue
+                    with st["lock"]:
+                        if st.get("committed"):
+                            continue   # réponse déjà enregistrée: on attend son résultat
+                        st["expired"] = True
+                    # le thread ne peut pas être interrompu: il garde son slot jusqu'au bout
+                    pending.pop(fut)
+                    expired += 1
+                    yield json.dumps({"i": i, "user_id": _job_user_id(job), "ok": False,
+                                      "error": "timeout",
+                                      "detail": "job toujours en cours en arrière-plan: "
+                                                "message IN enregistré, réponse ni "
+                                                "enregistrée ni envoyée",
+                                      "ms": round((now - st["started"]) * 1000)},
+                                     ensure_ascii=False) + "\n"
+                _fill()
+        finally:
+            # client déconnecté ou fin normale: on annule ce qui n'a pas démarré
+            for fut in pending:
+                fut.cancel()
+            pool.shutdown(wait=False)
+        dt = round((time.time() - t0) * 1000)
+        print(f"[BATCH] id={req_id} jobs={len(jobs)} ok={ok} err={failed} timeout={expired} "
+              f"conc={concurrency} no_llm={no_llm} deliver={deliver} {dt}ms", flush=True)
+        yield json.dumps({"done": True, "jobs": len(jobs), "ok": ok, "failed": failed,
+                          "timeout": expired, "ms": dt, "no_llm": no_llm}) + "\n"
+
+    return Response(_stream(), mimetype="application/x-ndjson")
+
+
+# ---- Export streaming (messages) ----
+# GET /internal/export?format=ndjson|csv&gzip=1&since_id=N&batch=N
+#   → flux NDJSON/CSV (mémoire bornée). NDJSON: dernière ligne
+#     {"done": true, "last_id": N} = high-water mark à repasser en since_id;
+#     absente si le flux a été coupé → relancer avec le même since_id.
+#   CSV: header X-Export-Last-Id, valable seulement si le téléchargement est complet.
+# GET /internal/export/stats?since_id=N → agrégats par user (une passe streaming)
+def _export_module():
+    # import local: le noyau peut être template/lanai_core/core.py (module, pas package)
+    try:
+        from core import export as m
+        return m
+    except ImportError as e:
+        print(f"[EXPORT][err] core.export indisponible: {e}", flush=True)
+        return None
+
+@app.route("/internal/export", methods=["GET"])
+def internal_export():
+    if not _internal_authorized(request):
+        return jsonify({"error":"forbidden"}), 403
+    msg_export = _export_module()
+    if msg_export is None:
+        return jsonify({"error": "export unavailable"}), 503
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+    try:
+        since_id = int(request.args.get("since_id", "0"))
+        batch = max(1, int(request.args.get("batch", msg_export.EXPORT_BATCH)))
+    except ValueError:
+        return jsonify({"error": "bad since_id/batch"}), 400
+    use_gzip = (request.args.get("gzip","0") == "1")
+
+    # borne haute figée au départ : export cohérent même si le webhook écrit en parallèle
+    try:
+        until_id = msg_export.max_id()
+    except Exception as e:
+        print(f"[EXPORT][err] {e}", flush=True)
+        return jsonify({"error": "database unavailable"}), 503
+    last_id = max(until_id, since_id)
+    rows = msg_export.iter_messages(since_id, until_id, batch)
+    headers = {"X-Export-Since-Id": str(since_id)}
+    if fmt == "csv":
+        body = msg_export.iter_lines(rows, fmt)
+        headers["X-Export-Last-Id"] = str(last_id)
+        mimetype = "text/csv"
+    else:
+        def _ndjson():
+            n = 0
+            for line in msg_export.iter_lines(rows, fmt):
+                n += 1
+                yield line
+            # envoyé seulement une fois toutes les lignes émises
+            yield json.dumps({"done": True, "since_id": since_id, "last_id": last_id, "rows": n}) + "\n"
+        body = _ndjson()
+        mimetype = "application/x-ndjson"
+    if use_gzip:
+        body = msg_export.iter_gzip(body)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route("/internal/export/stats", methods=["GET"])
+def internal_export_stats():
+    if not _internal_authorized(request):
+        return jsonify({"error":"forbidden"}), 403
+    msg_export = _export_module()
+    if msg_export is None:
+        return jsonify({"error": "export unavailable"}), 503
+    try:
+        since_id = int(request.args.get("since_id", "0"))
+    except ValueError:
+        return jsonify({"error": "bad since_id"}), 400
+    t0 = time.time()
+    stats = msg_export.UserStats()
+    try:
+        until_id = msg_export.max_id()
+        for row in msg_export.iter_messages(since_id, until_id):
+            stats.add(row)
+    except Exception as e:
+        print(f"[EXPORT][err] {e}", flush=True)
+        return jsonify({"error": "database unavailable"}), 503
+    dt = round((time.time()-t0)*1000)
+    return jsonify({"ok": True, "ms": dt, "since_id": since_id,
+                    "last_id": max(until_id, since_id), "users": stats.result()}), 200
+
+
 def _worker_process(sender: str, text_in: str, msg_sid: str | None):
     try:
         print(f"[IN] id={getattr(g,'req_id','-')} {sender} sid={msg_sid} text={text_in[:120]}", flush=True)
@@ -0,0 +1,286 @@
+# core/export.py — export streaming de la table messages (+ agrégats par user)
+# - Lecture par lots (keyset sur id + fetchmany) : mémoire bornée, quelle que soit la taille
+# - Chaque lot = une requête courte : ne bloque pas les écritures du webhook (WAL)
+# - Incrémental : high-water mark sur id (fichier d'état JSON côté CLI)
+# - Sorties : NDJSON ou CSV, gzip optionnel
+#
+# CLI : python -m core.export --out export.ndjson.gz --state export_state.json --stats stats.json
+#       (avec --state, --out et stats.json sont cumulés d'un run à l'autre)
+
+import os, io, sys, csv, json, gzip, shutil, sqlite3, zlib, argparse, pathlib
+from typing import Dict, Iterable, Iterator, Optional
+
+from .memory import DB_PATH
+
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "1000"))
+COLUMNS = ("id", "user_id", "ts", "direction", "text")
+
+def _read_conn(db_path: Optional[str] = None):
+    # lecture seule: ne crée jamais le fichier si le chemin n'existe pas
+    uri = pathlib.Path(db_path or DB_PATH).absolute().as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True, timeout=10, check_same_thread=False)
+
+def max_id(db_path: Optional[str] = None) -> int:
+    conn = _read_conn(db_path)
+    try:
+        row = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()
+    finally:
+        conn.close()
+    return int(row[0])
+
+def iter_messages(since_id: int = 0, until_id: Optional[int] = None,
+                  batch_size: int = EXPORT_BATCH, db_path: Optional[str] = None) -> Iterator[Dict]:
+    """
+    Itère les messages id > since_id (et <= until_id) dans l'ordre des id.
+    Un lot de batch_size lignes par requête : pas de transaction longue,
+    donc pas de snapshot WAL épinglé pendant tout l'export.
+    """
+    if until_id is None:
+        until_id = max_id(db_path)
+    last = int(since_id or 0)
+    conn = _read_conn(db_path)
+    try:
+        while last < until_id:
+            cur = conn.execute(
+                "SELECT id, user_id, ts, direction, text FROM messages "
+                "WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                (last, until_id, batch_size)
+            )
+            rows = cur.fetchmany(batch_size)
+            cur.close()
+            if not rows:
+                break
+            for r in rows:
+                yield dict(zip(COLUMNS, r))
+            last = rows[-1][0]
+    finally:
+        conn.close()
+
+# ---------- Sérialisation ----------
+def iter_ndjson(rows: Iterable[Dict]) -> Iterator[str]:
+    for r in rows:
+        yield json.dumps(r, ensure_ascii=False) + "\n"
+
+def iter_csv(rows: Iterable[Dict], header: bool = True) -> Iterator[str]:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    if header:
+        w.writerow(COLUMNS)
+    for r in rows:
+        w.writerow([r[c] for c in COLUMNS])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue()
+
+def iter_lines(rows: Iterable[Dict], fmt: str = "ndjson", header: bool = True) -> Iterator[str]:
+    if fmt == "csv":
+        return iter_csv(rows, header)
+    if fmt == "ndjson":
+        return iter_ndjson(rows)
+    raise ValueError(f"format inconnu: {fmt}")
+
+def iter_gzip(chunks: Iterable[str], flush_bytes: int = 64 * 1024) -> Iterator[bytes]:
+    """Compresse un flux de str en gzip, par blocs (~flush_bytes en entrée)."""
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)   # wbits=31 → en-tête gzip
+    pending = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        pending += len(data)
+        out = z.compress(data)
+        if pending >= flush_bytes:
+            out += z.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if out:
+            yield out
+    yield z.flush()
+
+# ---------- Agrégats (une seule passe) ----------
+class UserStats:
+    """Agrégats par user_id, alimentés ligne à ligne (mémoire ~ users × jours)."""
+
+    def __init__(self, users: Optional[Dict[str, Dict]] = None):
+        # users: compteurs bruts d'un run précédent (cf. raw()) pour cumuler
+        self.users = users or {}   # type: Dict[str, Dict]
+
+    def add(self, row: Dict):
+        u = self.users.get(row["user_id"])
+        if u is None:
+            u = self.users[row["user_id"]] = {
+                "in": 0, "out": 0, "out_chars": 0, "out_chars_max": 0,
+                "first_ts": None, "last_ts": None, "daily": {},
+            }
+        if row["direction"] == "IN":
+            u["in"] += 1
+        else:
+            n = len(row["text"] or "")
+            u["out"] += 1
+            u["out_chars"] += n
+            if n > u["out_chars_max"]:
+                u["out_chars_max"] = n
+        ts = str(row["ts"] or "")
+        if ts:
+            if u["first_ts"] is None or ts < u["first_ts"]:
+                u["first_ts"] = ts
+            if u["last_ts"] is None or ts > u["last_ts"]:
+                u["last_ts"] = ts
+            day = ts[:10]
+            u["daily"][day] = u["daily"].get(day, 0) + 1
+
+    def tap(self, rows: Iterable[Dict]) -> Iterator[Dict]:
+        """Laisse passer les lignes en les comptant (export + stats en une passe)."""
+        for r in rows:
+            self.add(r)
+            yield r
+
+    def raw(self) -> Dict[str, Dict]:
+        """Compteurs bruts, sérialisables en JSON (persistés dans le fichier d'état)."""
+        return self.users
+
+    def result(self) -> Dict[str, Dict]:
+        out = {}
+        for user_id, u in self.users.items():
+            out[user_id] = {
+                "messages": u["in"] + u["out"],
+                "in": u["in"],
+                "out": u["out"],
+                "in_out_ratio": round(u["in"] / u["out"], 3) if u["out"] else None,
+                "reply_chars_avg": round(u["out_chars"] / u["out"], 1) if u["out"] else 0,
+                "reply_chars_max": u["out_chars_max"],
+                "first_ts": u["first_ts"],
+                "last_ts": u["last_ts"],
+                "active_days": len(u["daily"]),
+                "daily": dict(sorted(u["daily"].items())),
+            }
+        return out
+
+# ---------- État incrémental ----------
+# {"last_id": N, "stats": {...}} — stats = compteurs bruts UserStats, si --stats
+def load_state(path: str) -> Dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {}
+    state["last_id"] = int(state.get("last_id", 0))
+    return state
+
+def _write_json_atomic(path: str, obj):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+def save_state(path: str, last_id: int, stats: Optional[UserStats] = None):
+    state = {"last_id": last_id}
+    if stats is not None:
+        state["stats"] = stats.raw()
+    _write_json_atomic(path, state)
+
+# ---------- CLI ----------
+def _append_file(src: str, dst: str):
+    # concaténation brute (membres gzip successifs = gzip valide); en cas
+    # d'échec, dst est ramené à sa taille d'origine
+    size = os.path.getsize(dst)
+    with open(dst, "ab") as out:
+        try:
+            with open(src, "rb") as f:
+                shutil.copyfileobj(f, out)
+        except BaseException:
+            out.truncate(size)
+            raise
+
+def export_to_file(out_path: str, fmt: Optional[str] = None, since_id: int = 0,
+                   batch_size: int = EXPORT_BATCH, stats: Optional[UserStats] = None,
+                   db_path: Optional[str] = None, append: bool = False) -> Dict:
+    """
+    append=True (mode incrémental): ajoute à out_path au lieu de l'écraser
+    (.gz → nouveau membre gzip), en-tête CSV seulement si le fichier est neuf.
+    Le run est d'abord écrit dans out_path.part, puis ajouté / renommé une fois
+    complet: un run en échec ne laisse rien dans out_path.
+    """
+    if fmt is None:
+        fmt = "csv" if ".csv" in os.path.basename(out_path) else "ndjson"
+    until = max_id(db_path)
+    rows = iter_messages(since_id, until, batch_size, db_path)
+    if stats is not None:
+        rows = stats.tap(rows)
+    count = 0
+    def _counted(it):
+        nonlocal count
+        for r in it:
+            count += 1
+            yield r
+    is_new = not append or not os.path.exists(out_path) or os.path.getsize(out_path) == 0
+    opener = gzip.open if out_path.endswith(".gz") else open
+    part = out_path + ".part"
+    try:
+        with opener(part, "wt", encoding="utf-8", newline="") as f:
+            for line in iter_lines(_counted(rows), fmt, header=is_new):
+                f.write(line)
+        if is_new:
+            os.replace(part, out_path)
+        else:
+            _append_file(part, out_path)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    return {"rows": count, "since_id": since_id, "last_id": until, "format": fmt}
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(prog="python -m core.export",
+                                description="Export streaming de la table messages.")
+    p.add_argument("--out", help="fichier de sortie (.ndjson/.csv, + .gz pour compresser)")
+    p.add_argument("--format", choices=("ndjson", "csv"), help="défaut: déduit de --out")
+    p.add_argument("--since-id", type=int, default=None, help="exporter id > N")
+    p.add_argument("--state", help="fichier JSON du high-water mark (lu puis mis à jour); "
+                                   "requiert --out, cumule --stats d'un run à l'autre")
+    p.add_argument("--stats", help="écrire les agrégats par user (JSON) dans ce fichier")
+    p.add_argument("--batch", type=int, default=EXPORT_BATCH, help="lignes par lot")
+    p.add_argument("--db", default=None, help=f"chemin SQLite (défaut: {DB_PATH})")
+    a = p.parse_args(argv)
+    if not a.out and not a.stats:
+        p.error("--out et/ou --stats requis")
+    if a.state and not a.out:
+        p.error("--state requiert --out (le high-water mark suit l'export écrit)")
+
+    db = a.db or DB_PATH
+    if not os.path.exists(db):
+        print(f"[EXPORT][err] base introuvable: {db} (DB_PATH / --db)", file=sys.stderr)
+        return 1
+
+    state = load_state(a.state) if a.state else {"last_id": 0}
+    since = a.since_id if a.since_id is not None else state["last_id"]
+    try:
+        stats = None
+        if a.stats:
+            if a.state and since == state["last_id"] and "stats" in state:
+                # incrémental: on repart des compteurs cumulés au dernier run
+                stats = UserStats(state["stats"])
+            else:
+                stats = UserStats()
+                if a.state and since:
+                    # pas de compteurs pour ]0, since] : on les recalcule une fois
+                    for r in iter_messages(0, since, a.batch, db):
+                        stats.add(r)
+        if a.out:
+            # avec --state, chaque run complète --out au lieu de l'écraser
+            info = export_to_file(a.out, a.format, since, a.batch, stats, db, append=bool(a.state))
+        else:
+            until = max_id(db)
+            for r in iter_messages(since, until, a.batch, db):
+                stats.add(r)
+            info = {"rows": None, "since_id": since, "last_id": until}
+        if stats is not None:
+            _write_json_atomic(a.stats, stats.result())
+        if a.state:
+            save_state(a.state, max(info["last_id"], since), stats)
+    except (sqlite3.Error, OSError) as e:
+        print(f"[EXPORT][err] {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(info), flush=True)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -13,6 +13,11 @@ curl.exe -s -o NUL -w "HEALTH %%{http_code}\n" "%BASE%/health"
 curl.exe -s -o NUL -w "SEND %%{http_code}\n" -X POST "%BASE%/internal/send?format=text" ^
  -H "X-Token: %TOKEN%" -H "Content-Type: application/json" ^
  -d "{\"text\":\"ping\"}"
+curl.exe -s -X POST "%BASE%/internal/send/batch?nollm=1" ^
+ -H "X-Token: %TOKEN%" -H "Content-Type: application/json" ^
+ -d "[{\"user_id\":\"smoke\",\"text\":\"ping\"}]" | find "\"done\": true" >nul && (echo BATCH ok) || (echo BATCH KO)
+curl.exe -s -o NUL -w "EXPORT %%{http_code}\n" "%BASE%/internal/export?since_id=0&batch=100" ^
+ -H "X-Token: %TOKEN%"
 curl.exe -s -o NUL -w "CHECKIN %%{http_code}\n" -X POST "%BASE%/internal/checkin" ^
  -H "X-Token: %TOKEN%" -H "Content-Type: application/json" ^
  -d "{\"dry_run\":true}"
@@ -4,5 +4,9 @@ echo [Smoke] Test /health...
 curl.exe -s http://127.0.0.1:5000/health | find "\"status\":\"ok\"" >nul || (echo [X] /health KO & exit /b 1)
 echo [Smoke] Test /internal/send...
 curl.exe -s -X POST http://127.0.0.1:5000/internal/send -H "Content-Type: application/json" -d "{\"text\":\"Salut\"}" | find "\"ok\": true" >nul || (echo [X] /internal/send KO & exit /b 1)
+echo [Smoke] Test /internal/send/batch...
+curl.exe -s -X POST "http://127.0.0.1:5000/internal/send/batch?nollm=1" -H "X-Token: %INTERNAL_TOKEN%" -H "Content-Type: application/json" -d "[{\"user_id\":\"smoke\",\"text\":\"Salut\"}]" | find "\"done\": true" >nul || (echo [X] /internal/send/batch KO & exit /b 1)
+echo [Smoke] Test /internal/export...
+curl.exe -s -o NUL -w "%%{http_code}" "http://127.0.0.1:5000/internal/export" -H "X-Token: %INTERNAL_TOKEN%" | find "200" >nul || (echo [X] /internal/export KO & exit /b 1)
 echo [OK] Smoke test passe.
 exit /b 0